@@ -1,28 +1,77 @@
 import os
-import json
+import orjson
 import io
 import tempfile
-from typing import Optional
+import shutil
+import subprocess
+from typing import Optional, Union
 import httpx
-import pdfplumber
+try:
+    import pymupdf as fitz
+except ImportError:  # PyMuPDF is AGPL; deployments may swap it for pdfminer.six
+    fitz = None
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # Apache-2.0 PDFium bindings, the next-fastest option
+    pdfium = None
+try:
+    from pdfminer.high_level import extract_text as pdfminer_extract
+except ImportError:
+    pdfminer_extract = None
 import docx
 from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
+import google_auth_httplib2
+import httplib2
 import asyncpg
-import datetime
+import re
+import copy
+import hashlib
+import gzip
+import time
+import random
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
 
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
 GROQ_API_URL = os.environ.get("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
 GOOGLE_SERVICE_ACCOUNT_JSON = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")  # JSON string
 DATABASE_URL = os.environ.get("DATABASE_URL")  # Neon Postgres connection string
+GROQ_MODEL = "openai/gpt-oss-120b"  # same as your Supabase config
+GROQ_MAX_CHARS = int(os.environ.get("GROQ_MAX_CHARS", 32_000))  # ~8K tokens
+# Off by default: Groq hasn't documented support for gzip-encoded request bodies
+GROQ_GZIP_REQUESTS = os.environ.get("GROQ_GZIP_REQUESTS", "").lower() in ("1", "true", "yes")
+GROQ_CACHE_SIZE = int(os.environ.get("GROQ_CACHE_SIZE", 1024))
+GROQ_CACHE_TTL = float(os.environ.get("GROQ_CACHE_TTL", 86400))  # seconds
+RESUME_CACHE_TTL = float(os.environ.get("RESUME_CACHE_TTL", 86400))  # seconds
+# The cache lookup sits in front of every parse, so a slow DB must not stall requests
+RESUME_CACHE_TIMEOUT = float(os.environ.get("RESUME_CACHE_TIMEOUT", 1.0))  # seconds
+PERSIST_BATCH_SIZE = int(os.environ.get("PERSIST_BATCH_SIZE", 100))
+PERSIST_FLUSH_INTERVAL = float(os.environ.get("PERSIST_FLUSH_INTERVAL", 1.0))  # seconds
+PERSIST_QUEUE_SIZE = int(os.environ.get("PERSIST_QUEUE_SIZE", 10_000))
+DRIVE_CHUNK_SIZE = int(os.environ.get("DRIVE_CHUNK_SIZE", 8 * 1024 * 1024))
+# Consecutive LLM-confirmed parses before a resume template is handled locally (0 disables)
+TEMPLATE_PROMOTE_AFTER = int(os.environ.get("TEMPLATE_PROMOTE_AFTER", 5))
+# Share of promoted-template parses still sent to the LLM to catch templates that drift
+TEMPLATE_RECHECK_RATE = float(os.environ.get("TEMPLATE_RECHECK_RATE", 0.1))
+TEMPLATE_REFRESH_INTERVAL = float(os.environ.get("TEMPLATE_REFRESH_INTERVAL", 60))  # seconds
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", min(4, os.cpu_count() or 1)))
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", 8))
 
 if not GROQ_API_KEY or not GOOGLE_SERVICE_ACCOUNT_JSON or not DATABASE_URL:
     raise RuntimeError("Set GROQ_API_KEY, GOOGLE_SERVICE_ACCOUNT_JSON, and DATABASE_URL environment variables")
 
-SERVICE_ACCOUNT_INFO = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
+if fitz is None and pdfium is None and pdfminer_extract is None:
+    raise RuntimeError("Install pymupdf, pypdfium2 or pdfminer.six for PDF text extraction")
+
+SERVICE_ACCOUNT_INFO = orjson.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
 
 # Build drive service once at startup
@@ -31,14 +80,49 @@ _creds = service_account.Credentials.from_service_account_info(
 )
 DRIVE_SERVICE = build("drive", "v3", credentials=_creds)
 
+# httplib2 is not thread-safe, so each download thread gets its own authorized Http
+_drive_http = threading.local()
+
+def _get_drive_http() -> google_auth_httplib2.AuthorizedHttp:
+    http = getattr(_drive_http, "http", None)
+    if http is None:
+        http = _drive_http.http = google_auth_httplib2.AuthorizedHttp(_creds, http=httplib2.Http())
+    return http
+
+# Poppler's pdftotext is much faster than the Python PDF parsers; probe for it once
+_HAVE_PDFTOTEXT = shutil.which("pdftotext") is not None
+
 app = FastAPI(title="Resume Parser")
 
 # Database pool (initialized at startup)
 db_pool = None
 
+# Shared Groq HTTP client so TLS connections are reused across requests
+GROQ_CLIENT: Optional[httpx.AsyncClient] = None
+
+# Process pool for splitting long PDFs across cores (initialized at startup)
+PDF_POOL: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+PDF_POOL_TIMEOUT = 20  # seconds, same budget as pdftotext
+
+def _new_pdf_pool() -> ProcessPoolExecutor:
+    # forkserver: forking from a request thread could copy a lock held by MuPDF or SSL
+    return ProcessPoolExecutor(
+        max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+    )
+
+def _replace_pdf_pool(broken: ProcessPoolExecutor) -> None:
+    global PDF_POOL
+    with _pdf_pool_lock:
+        if PDF_POOL is broken:
+            PDF_POOL = _new_pdf_pool()
+    # No cancel_futures: other requests may still be waiting on this pool
+    broken.shutdown(wait=False)
+
 async def init_db():
     global db_pool
-    db_pool = await asyncpg.create_pool(DATABASE_URL)
+    # asyncpg prepares each distinct query once per connection and reuses the plan
+    db_pool = await asyncpg.create_pool(DATABASE_URL, statement_cache_size=1024)
     # Create table if not exists
     async with db_pool.acquire() as conn:
         await conn.execute('''
@@ -54,80 +138,573 @@ async def init_db():
                 parsed_at TIMESTAMP NOT NULL DEFAULT NOW()
             )
         ''')
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS resumes_file_id_parsed_at_idx ON resumes (file_id, parsed_at DESC)"
+        )
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS templates (
+                template_id TEXT PRIMARY KEY,
+                agreements INTEGER NOT NULL DEFAULT 0,
+                promoted BOOLEAN NOT NULL DEFAULT FALSE,
+                updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        ''')
+
+# parsed_at is filled by the column default, so freshness is checked against the DB clock
+_CACHE_LOOKUP_SQL = '''
+    SELECT name, email, phone, skills, experience, education
+    FROM resumes
+    WHERE file_id = $1 AND parsed_at > LOCALTIMESTAMP - make_interval(secs => $2)
+    ORDER BY parsed_at DESC LIMIT 1
+'''
+
+async def _cache_lookup(conn, file_id: str) -> Optional[dict]:
+    row = await conn.fetchrow(_CACHE_LOOKUP_SQL, file_id, RESUME_CACHE_TTL, timeout=RESUME_CACHE_TIMEOUT)
+    if row is None:
+        return None
+    return {
+        "name": row["name"],
+        "email": row["email"],
+        "phone": row["phone"],
+        "skills": row["skills"] or [],
+        "experience": row["experience"] or [],
+        "education": row["education"] or [],
+    }
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks: set = set()
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Parsed resumes are queued and written in batches with COPY by a background task
+_RESUME_COLUMNS = ["file_id", "name", "email", "phone", "skills", "experience", "education"]
+_persist_queue: Optional[asyncio.Queue] = None
+_writer_task: Optional[asyncio.Task] = None
+
+# LLM output doesn't always follow the schema (dict entries, bare strings, numbers);
+# one badly typed value would fail the whole COPY batch, so coerce to the column types
+def _as_text(value) -> Optional[str]:
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        value = ", ".join(filter(None, map(_as_text, value.values())))
+    elif isinstance(value, list):
+        value = ", ".join(filter(None, map(_as_text, value)))
+    elif not isinstance(value, str):
+        value = str(value)
+    return value.replace("\x00", "")  # Postgres text can't hold NUL
+
+def _as_text_list(value) -> list:
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        value = [value]
+    return [text for text in map(_as_text, value) if text]
+
+def _persist(file_id: str, parsed: dict) -> None:
+    try:
+        _persist_queue.put_nowait((
+            file_id,
+            _as_text(parsed.get("name")),
+            _as_text(parsed.get("email")),
+            _as_text(parsed.get("phone")),
+            _as_text_list(parsed.get("skills")),
+            _as_text_list(parsed.get("experience")),
+            _as_text_list(parsed.get("education")),
+        ))
+    except asyncio.QueueFull:
+        pass  # DB writes are best-effort; drop rather than block requests
+
+async def _flush_resumes(records: list) -> None:
+    try:
+        async with db_pool.acquire() as conn:
+            await conn.copy_records_to_table("resumes", records=records, columns=_RESUME_COLUMNS)
+    except Exception:
+        pass  # Silently ignore DB errors
+
+async def _resume_writer() -> None:
+    loop = asyncio.get_running_loop()
+    batch = []
+    try:
+        while True:
+            batch.append(await _persist_queue.get())
+            deadline = loop.time() + PERSIST_FLUSH_INTERVAL
+            while len(batch) < PERSIST_BATCH_SIZE:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_persist_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Keep the batch until the write finishes so a cancel mid-flush retries it
+            await _flush_resumes(batch)
+            batch = []
+    except asyncio.CancelledError:
+        # Shutting down: write out whatever is still buffered, including a batch
+        # whose flush was interrupted
+        while not _persist_queue.empty():
+            batch.append(_persist_queue.get_nowait())
+        if batch:
+            await _flush_resumes(batch)
+        raise
 
 @app.on_event("startup")
 async def on_startup():
+    global GROQ_CLIENT, PDF_POOL, _persist_queue, _writer_task
+    # Blocking Drive downloads and text extraction run in this pool
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=32))
+    GROQ_CLIENT = httpx.AsyncClient(
+        timeout=httpx.Timeout(30.0),
+        limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+        http2=True,
+    )
+    if PDF_WORKERS > 1:
+        PDF_POOL = _new_pdf_pool()
     await init_db()
+    await _refresh_promoted()
+    _persist_queue = asyncio.Queue(maxsize=PERSIST_QUEUE_SIZE)
+    _writer_task = asyncio.create_task(_resume_writer())
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if _writer_task is not None:
+        _writer_task.cancel()
+        try:
+            await _writer_task
+        except asyncio.CancelledError:
+            pass
+    if GROQ_CLIENT is not None:
+        await GROQ_CLIENT.aclose()
+    if PDF_POOL is not None:
+        PDF_POOL.shutdown(wait=False, cancel_futures=True)
+
+# Downloaded file contents; a memoryview over the download buffer avoids copies
+FileData = Union[bytes, memoryview]
 
 class ParseRequest(BaseModel):
     fileId: str
     mimeType: Optional[str] = None
 
-def extract_text_from_pdf_bytes(data: bytes) -> str:
-    text = ""
-    with pdfplumber.open(io.BytesIO(data)) as pdf:
-        for p in pdf.pages:
-            text += p.extract_text() or ""
-    return text.strip()
+def _download(file_id: str) -> memoryview:
+    request_drive = DRIVE_SERVICE.files().get_media(fileId=file_id)
+    request_drive.http = _get_drive_http()
+    fh = io.BytesIO()
+    # Large chunks so a typical resume downloads in a single round-trip
+    downloader = MediaIoBaseDownload(fh, request_drive, chunksize=DRIVE_CHUNK_SIZE)
+    done = False
+    while not done:
+        status, done = downloader.next_chunk()
+    return fh.getbuffer()
 
-def extract_text_from_docx_bytes(data: bytes) -> str:
+def extract_text_with_pdftotext(data: FileData) -> Optional[str]:
+    try:
+        proc = subprocess.run(
+            ["pdftotext", "-q", "-enc", "UTF-8", "-", "-"],
+            input=data,
+            capture_output=True,
+            timeout=20,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if proc.returncode != 0:
+        return None
+    return proc.stdout.decode("utf-8", "ignore").strip()
+
+# Text-only extraction: no image blocks, ligatures expanded to plain characters
+if fitz is not None:
+    _PDF_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_IMAGES & ~fitz.TEXT_PRESERVE_LIGATURES
+
+def _extract_pdf_page_range(data: bytes, start: int, stop: int) -> str:
+    doc = fitz.open(stream=data, filetype="pdf")
+    try:
+        return "\n".join(doc[i].get_text("text", flags=_PDF_TEXT_FLAGS) for i in range(start, stop))
+    finally:
+        doc.close()
+
+def extract_text_with_pdfium(data: FileData) -> str:
+    # PDFium wants bytes or a file object, not a memoryview
+    pdf = pdfium.PdfDocument(bytes(data))
+    try:
+        text = "\n".join(page.get_textpage().get_text_range() for page in pdf)
+    finally:
+        pdf.close()
+    return text.replace("\r\n", "\n").strip()
+
+def extract_text_with_pdfminer(data: FileData) -> str:
+    # Default LAParams: no pdfplumber object layer on top of pdfminer
+    return pdfminer_extract(io.BytesIO(data), laparams=None).strip()
+
+def extract_text_from_pdf_bytes(data: FileData) -> str:
+    # Fast path: pdftotext if installed, else the slower Python parsers
+    if _HAVE_PDFTOTEXT:
+        text = extract_text_with_pdftotext(data)
+        if text is not None:
+            return text
+    if fitz is None:
+        if pdfium is not None:
+            return extract_text_with_pdfium(data)
+        return extract_text_with_pdfminer(data)
+    doc = fitz.open(stream=data, filetype="pdf")
+    try:
+        n = doc.page_count
+        if PDF_POOL is None or n < PDF_PARALLEL_MIN_PAGES:
+            return "\n".join(p.get_text("text", flags=_PDF_TEXT_FLAGS) for p in doc).strip()
+    finally:
+        doc.close()
+
+    # Long documents: extract contiguous page ranges in separate processes
+    # (memoryviews can't be pickled, so this path takes one copy)
+    data = bytes(data)
+    step = -(-n // PDF_WORKERS)
+    starts = range(0, n, step)
+    pool = PDF_POOL
+    try:
+        futures = [
+            pool.submit(_extract_pdf_page_range, data, start, min(start + step, n))
+            for start in starts
+        ]
+        _, pending = wait(futures, timeout=PDF_POOL_TIMEOUT)
+        if pending:
+            # Too slow: give up on this document only; the pool stays shared
+            for f in futures:
+                f.cancel()
+            raise TimeoutError("PDF text extraction timed out")
+        parts = [f.result() for f in futures]
+    except (BrokenProcessPool, CancelledError):
+        # A worker crashed: start a fresh pool and do this one serially
+        _replace_pdf_pool(pool)
+        return _extract_pdf_page_range(data, 0, n).strip()
+    except RuntimeError:
+        # Pool was shut down under us (replaced or app stopping)
+        return _extract_pdf_page_range(data, 0, n).strip()
+    return "\n".join(parts).strip()
+
+def extract_text_from_docx_bytes(data: FileData) -> str:
+    # Read the w:p elements directly instead of building python-docx Paragraph
+    # objects; CT_P.text renders tabs and line breaks the same way Paragraph.text does
     doc = docx.Document(io.BytesIO(data))
-    return "\n".join([p.text for p in doc.paragraphs if p.text]).strip()
+    paragraphs = doc.element.body.xpath(".//w:p[not(ancestor::w:p)]")
+    lines = (p.text for p in paragraphs)
+    return "\n".join(line for line in lines if line).strip()
+
+PDF_MIME = "application/pdf"
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+_DOCX_MARKER = re.compile(rb"word/")
+
+def _sniff(data: FileData) -> Optional[str]:
+    if data[:5] == b"%PDF-":
+        return PDF_MIME
+    if data[:4] == b"PK\x03\x04" and _DOCX_MARKER.search(data):
+        return DOCX_MIME
+    return None
 
-def extract_text_from_bytes(data: bytes, mime_type: Optional[str]) -> str:
+def extract_text_from_bytes(data: FileData, mime_type: Optional[str]) -> str:
+    # Magic bytes win over the client's label, which may be missing or wrong
+    mime_type = _sniff(data) or mime_type
     # PDF
-    if mime_type == "application/pdf":
+    if mime_type == PDF_MIME:
         return extract_text_from_pdf_bytes(data)
     # DOCX
-    if mime_type in (
-        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        "application/msword",
-    ):
+    if mime_type in (DOCX_MIME, "application/msword"):
         return extract_text_from_docx_bytes(data)
     # Fallback: try reading as text
     try:
-        return data.decode(errors="ignore")
+        return str(data, "utf-8", "ignore")
     except Exception:
         return ""
     
-async def call_groq_api(cv_text: str, timeout: float = 30.0):
-    headers = {
-        "Authorization": f"Bearer {GROQ_API_KEY}",
-        "Content-Type": "application/json",
-    }
+# Contact fields are cheap to pull out locally, so the LLM doesn't have to
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+PHONE_RE = re.compile(r"\+?\(?\d[\d \t().-]{7,}\d")
+PHONE_LABEL_RE = re.compile(r"\b(?:phone|tel|mobile|cell|mob|ph)\.?(?:\s*(?:no|number|#))?\W*$", re.IGNORECASE)
 
-    payload = {
-        "model": "openai/gpt-oss-120b",  # same as your Supabase config
-        "messages": [
-            {
-                "role": "system",
-                "content": (
-                    "You are a resume parser. "
-                    "Extract candidate details and return JSON with this schema:\n"
-                    "{\n"
-                    '  "name": string,\n'
-                    '  "email": string,\n'
-                    '  "phone": string,\n'
-                    '  "skills": [string],\n'
-                    '  "experience": [string],\n'
-                    '  "education": [string]\n'
-                    "}"
-                )
-            },
-            {"role": "user", "content": cv_text}
-        ],
-        "temperature": 0.0,
-        "max_tokens": 1024,
-        "response_format": {"type": "json_object"}  # ✅ Ensures JSON output
-    }
+def _phone_candidates(cv_text: str):
+    # Yields (number, labelled) for every phone-shaped match in document order
+    for m in PHONE_RE.finditer(cv_text):
+        number = m.group(0).strip()
+        # E.164 numbers have 10-15 digits; anything else is a date range or ID
+        if not 10 <= sum(c.isdigit() for c in number) <= 15:
+            continue
+        labelled = PHONE_LABEL_RE.search(cv_text, max(0, m.start() - 20), m.start()) is not None
+        # A bare digit run could be any ID; it needs a label
+        if number.isdigit() and not labelled:
+            continue
+        yield number, labelled
+
+def extract_contact_fields(cv_text: str) -> dict:
+    # Only values certain enough to override the LLM: an ISBN or national ID has
+    # the same shape as a phone, so the phone must be labelled or +-prefixed
+    known = {}
+    m = EMAIL_RE.search(cv_text)
+    if m:
+        known["email"] = m.group(0).rstrip(".")
+    labelled = prefixed = None
+    for number, is_labelled in _phone_candidates(cv_text):
+        if is_labelled:
+            labelled = number
+            break
+        if prefixed is None and number.startswith("+"):
+            prefixed = number
+    phone = labelled or prefixed
+    if phone:
+        known["phone"] = phone
+    return known
+
+# Section headings recognised in resume text, and the output field (if any)
+# whose content follows them
+_SECTION_FIELDS = {
+    "skills": "skills",
+    "technical skills": "skills",
+    "key skills": "skills",
+    "core competencies": "skills",
+    "experience": "experience",
+    "work experience": "experience",
+    "professional experience": "experience",
+    "employment history": "experience",
+    "work history": "experience",
+    "education": "education",
+    "academic background": "education",
+    "qualifications": "education",
+    "summary": None,
+    "profile": None,
+    "objective": None,
+    "projects": None,
+    "certifications": None,
+    "languages": None,
+    "interests": None,
+    "awards": None,
+    "publications": None,
+    "references": None,
+    "contact": None,
+}
+_BULLET_RE = re.compile(r"^[\s•·▪●◦*-]+")
+_SKILL_SPLIT_RE = re.compile(r"[,;|•·]")
+_SEPARATORS = ",;|•·"
+_URL_RE = re.compile(r"https?://|www\.|linkedin\.com|github\.com", re.IGNORECASE)
+
+def _line_kind(line: str) -> str:
+    # Content-free description of a line: what it holds and which separators it uses
+    kind = "".join(k for k, present in (
+        ("E", EMAIL_RE.search(line)),
+        ("P", PHONE_RE.search(line)),
+        ("U", _URL_RE.search(line)),
+    ) if present) or "T"
+    return kind + "".join(sorted({c for c in line if c in _SEPARATORS}))
 
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        r = await client.post(GROQ_API_URL, headers=headers, json=payload)
-        if r.status_code != 200:
-            raise HTTPException(status_code=r.status_code, detail=r.text)
-        data = r.json()
-        content = data.get("choices", [{}])[0].get("message", {}).get("content")
-        return json.loads(content)
+# Fingerprint the resume layout and pull fields out locally. The fingerprint covers
+# headings exactly as written, the shape of the contact block above them, and the
+# bullet and separator glyphs used in each section -- not the candidate's content.
+def analyze_layout(cv_text: str) -> tuple[Optional[str], dict]:
+    headers = []
+    shape = []
+    sections = {"skills": [], "experience": [], "education": []}
+    name = None
+    field = None
+    glyphs = set()
+    for raw in cv_text.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        heading = line.rstrip(":").lower()
+        if heading in _SECTION_FIELDS:
+            if headers:
+                shape.append("".join(sorted(glyphs)))
+            headers.append(line)
+            shape.append(line)
+            field = _SECTION_FIELDS[heading]
+            glyphs = set()
+            continue
+        if not headers:
+            if name is None:
+                name = line
+            shape.append(_line_kind(line))
+            continue
+        bullet = _BULLET_RE.match(line)
+        if bullet:
+            glyphs.update(bullet.group(0).strip())
+        glyphs.update(c for c in line if c in _SEPARATORS)
+        if field is not None:
+            item = _BULLET_RE.sub("", line)
+            if item:
+                sections[field].append(item)
+    if headers:
+        shape.append("".join(sorted(glyphs)))
+
+    local = {"name": name, "email": None, "phone": None, **extract_contact_fields(cv_text)}
+    local["skills"] = [
+        s for s in (part.strip() for line in sections["skills"] for part in _SKILL_SPLIT_RE.split(line)) if s
+    ]
+    local["experience"] = sections["experience"]
+    local["education"] = sections["education"]
+
+    if len(headers) < 2:
+        return None, local  # Too little structure to recognise a template
+    template_id = hashlib.blake2b("\x1f".join(shape).encode(), digest_size=8).hexdigest()
+    return template_id, local
+
+def _norm(value) -> str:
+    return " ".join((_as_text(value) or "").casefold().split())
+
+def _similar(a: str, b: str) -> bool:
+    ta, tb = set(a.split()), set(b.split())
+    return ta == tb or len(ta & tb) >= 0.8 * len(ta | tb)
+
+# The local result only counts as agreeing when it says what the LLM said:
+# same name and phone, nearly the same skills, and the same experience/education entries
+def _agrees(local: dict, parsed: dict) -> bool:
+    if not _norm(local["name"]) or _norm(local["name"]) != _norm(parsed.get("name")):
+        return False
+    if re.sub(r"\D", "", local["phone"] or "") != re.sub(r"\D", "", _as_text(parsed.get("phone")) or ""):
+        return False
+    llm_skills = {_norm(s) for s in _as_text_list(parsed.get("skills"))}
+    local_skills = {_norm(s) for s in local["skills"]}
+    if llm_skills != local_skills and len(llm_skills & local_skills) < 0.8 * len(llm_skills | local_skills):
+        return False
+    for f in ("experience", "education"):
+        llm_items = [_norm(i) for i in _as_text_list(parsed.get(f))]
+        local_items = [_norm(i) for i in local[f]]
+        if len(llm_items) != len(local_items):
+            return False
+        if not all(_similar(a, b) for a, b in zip(local_items, llm_items)):
+            return False
+    return True
+
+# Promoted template ids, cached in-process and refreshed in the background so the
+# check costs nothing on the request path
+_promoted_templates: set = set()
+_promoted_loaded_at = float("-inf")
+_promoted_refreshing = False
+
+async def _refresh_promoted() -> None:
+    global _promoted_templates, _promoted_loaded_at, _promoted_refreshing
+    try:
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch("SELECT template_id FROM templates WHERE promoted")
+        _promoted_templates = {r["template_id"] for r in rows}
+    except Exception:
+        pass  # Keep the previous set
+    finally:
+        _promoted_loaded_at = time.monotonic()
+        _promoted_refreshing = False
+
+def _template_promoted(template_id: str) -> bool:
+    global _promoted_refreshing
+    if not _promoted_refreshing and time.monotonic() - _promoted_loaded_at > TEMPLATE_REFRESH_INTERVAL:
+        # Set before spawning so requests in the same loop tick don't start their own
+        _promoted_refreshing = True
+        _spawn(_refresh_promoted())
+    return template_id in _promoted_templates
+
+async def _record_template(template_id: str, agreed: bool) -> None:
+    # A disagreement resets the streak (and demotes); N agreements in a row promote
+    try:
+        async with db_pool.acquire() as conn:
+            promoted = await conn.fetchval(
+                '''INSERT INTO templates (template_id, agreements, promoted)
+                   VALUES ($1, CASE WHEN $2 THEN 1 ELSE 0 END, $2 AND 1 >= $3)
+                   ON CONFLICT (template_id) DO UPDATE SET
+                       agreements = CASE WHEN $2 THEN templates.agreements + 1 ELSE 0 END,
+                       promoted = $2 AND templates.agreements + 1 >= $3,
+                       updated_at = NOW()
+                   RETURNING promoted''',
+                template_id,
+                agreed,
+                TEMPLATE_PROMOTE_AFTER,
+            )
+    except Exception:
+        return  # Silently ignore DB errors
+    if promoted:
+        _promoted_templates.add(template_id)
+    else:
+        _promoted_templates.discard(template_id)
+
+# In-process LRU of Groq results keyed by sha256(model + cv_text)
+_groq_cache: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+
+def _groq_cache_key(cv_text: str) -> str:
+    return hashlib.sha256(f"{GROQ_MODEL}\0{cv_text}".encode()).hexdigest()
+
+def _groq_cache_get(key: str) -> Optional[dict]:
+    entry = _groq_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, parsed = entry
+    if expires_at < time.monotonic():
+        del _groq_cache[key]
+        return None
+    _groq_cache.move_to_end(key)
+    return copy.deepcopy(parsed)
+
+def _groq_cache_set(key: str, parsed: dict) -> None:
+    _groq_cache[key] = (time.monotonic() + GROQ_CACHE_TTL, copy.deepcopy(parsed))
+    _groq_cache.move_to_end(key)
+    while len(_groq_cache) > GROQ_CACHE_SIZE:
+        _groq_cache.popitem(last=False)
+
+# Request pieces that are the same on every call; only the user message varies
+_HEADERS = {
+    "Authorization": f"Bearer {GROQ_API_KEY}",
+    "Content-Type": "application/json",
+}
+if GROQ_GZIP_REQUESTS:
+    _HEADERS["Content-Encoding"] = "gzip"
+
+_SYSTEM_MSG = {
+    "role": "system",
+    "content": (
+        "You are a resume parser. "
+        "Extract candidate details and return JSON with this schema:\n"
+        "{\n"
+        '  "name": string,\n'
+        '  "email": string,\n'
+        '  "phone": string,\n'
+        '  "skills": [string],\n'
+        '  "experience": [string],\n'
+        '  "education": [string]\n'
+        "}"
+    ),
+}
+
+_BASE_PAYLOAD = {
+    "model": GROQ_MODEL,
+    "temperature": 0.0,
+    "max_tokens": 1024,
+    "response_format": {"type": "json_object"},  # ✅ Ensures JSON output
+}
+
+# Returns (parsed, from_cache)
+async def call_groq_api(cv_text: str, known: Optional[dict] = None, timeout: float = 30.0) -> tuple[dict, bool]:
+    # Only the head of a resume matters; trailing appendices just add latency
+    cv_text = cv_text[:GROQ_MAX_CHARS]
+    if known:
+        cv_text = (
+            "Known fields (already extracted, copy as-is): "
+            + orjson.dumps(known).decode()
+            + "\n\n"
+            + cv_text
+        )
+    cache_key = _groq_cache_key(cv_text)
+    cached = _groq_cache_get(cache_key)
+    if cached is not None:
+        return cached, True
+
+    payload = {**_BASE_PAYLOAD, "messages": [_SYSTEM_MSG, {"role": "user", "content": cv_text}]}
+    body = orjson.dumps(payload)
+    if GROQ_GZIP_REQUESTS:
+        body = gzip.compress(body)
+    r = await GROQ_CLIENT.post(GROQ_API_URL, headers=_HEADERS, content=body, timeout=timeout)
+    if r.status_code != 200:
+        raise HTTPException(status_code=r.status_code, detail=r.text)
+    data = orjson.loads(r.content)
+    content = data.get("choices", [{}])[0].get("message", {}).get("content")
+    parsed = orjson.loads(content)
+    _groq_cache_set(cache_key, parsed)
+    return parsed, False
 
 
 @app.post("/parse")
@@ -141,40 +718,39 @@ async def parse_resume(req: ParseRequest, request: Request):
     # API timeout (seconds)
     api_timeout = float(request.headers.get("X-API-Timeout", 30.0))
 
+    # Serve a recent parse of the same file straight from Postgres
     try:
-        # Download file from Google Drive (blocking, but Google API is not async)
-        request_drive = DRIVE_SERVICE.files().get_media(fileId=file_id)
-        fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request_drive)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        fh.seek(0)
-
-        file_bytes = fh.read()
-        cv_text = extract_text_from_bytes(file_bytes, mime_type)
+        async with db_pool.acquire(timeout=RESUME_CACHE_TIMEOUT) as conn:
+            cached = await _cache_lookup(conn, file_id)
+    except Exception:
+        cached = None  # Cache is best-effort (including timeouts); fall through to a full parse
+    if cached is not None:
+        return {"fileId": file_id, "parsedData": cached}
+
+    try:
+        # Download and extract in worker threads (Google API is not async)
+        file_bytes = await asyncio.to_thread(_download, file_id)
+        cv_text = await asyncio.to_thread(extract_text_from_bytes, file_bytes, mime_type)
         if not cv_text.strip():
             raise HTTPException(status_code=400, detail="Could not extract text from file")
 
-        parsed = await call_groq_api(cv_text, timeout=api_timeout)
+        # Promoted templates are extracted locally, except for a sampled share that is
+        # re-checked; everything else goes to the LLM and is compared with the local result
+        template_id, local = analyze_layout(cv_text)
+        use_templates = template_id is not None and TEMPLATE_PROMOTE_AFTER > 0
+        if use_templates and _template_promoted(template_id) and random.random() >= TEMPLATE_RECHECK_RATE:
+            parsed = local
+        else:
+            known = extract_contact_fields(cv_text)
+            parsed, from_cache = await call_groq_api(cv_text, known, timeout=api_timeout)
+            parsed.update(known)
+            # A cached answer is the same evidence again (same resume re-uploaded or
+            # retried), so only fresh LLM answers count towards promotion
+            if use_templates and not from_cache:
+                _spawn(_record_template(template_id, _agrees(local, parsed)))
 
-        # Store parsed data in Neon Postgres (hidden from user)
-        try:
-            async with db_pool.acquire() as conn:
-                await conn.execute(
-                    '''INSERT INTO resumes (file_id, name, email, phone, skills, experience, education, parsed_at)
-                       VALUES ($1, $2, $3, $4, $5, $6, $7, $8)''',
-                    file_id,
-                    parsed.get("name"),
-                    parsed.get("email"),
-                    parsed.get("phone"),
-                    parsed.get("skills", []),
-                    parsed.get("experience", []),
-                    parsed.get("education", []),
-                    datetime.datetime.utcnow()
-                )
-        except Exception:
-            pass  # Silently ignore DB errors
+        # Store parsed data in Neon Postgres (hidden from user, off the response path)
+        _persist(file_id, parsed)
 
         return {"fileId": file_id, "parsedData": parsed}
 